@@ -33,6 +33,8 @@ import sys
 import time
 import zipfile
 from collections import namedtuple
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
 from typing import List
 from typing import NoReturn
@@ -50,12 +52,33 @@ from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
 logger = logging.getLogger(__name__)
 
 __author__ = 'Bitcraze AB'
-__all__ = ['Bootloader']
+__all__ = ['Bootloader', 'ParallelFlashError']
 
 Target = namedtuple('Target', ['platform', 'target', 'type'])
 FlashArtifact = namedtuple('FlashArtifact', ['content', 'target'])
 
 
+class ParallelFlashError(Exception):
+    """Raised by Bootloader.flash_parallel when some Crazyflies failed to
+    flash, errors maps the URI of each of them to the exception it raised"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('Flashing failed for {}'.format(', '.join(errors)))
+
+
+def _wait_for(predicate, timeout=10.0, interval=0.05):
+    """Poll predicate until it returns a truthy value or the timeout expires.
+    Returns the last value returned by predicate. The timeout is only checked
+    between calls, a predicate that blocks delays it."""
+    deadline = time.time() + timeout
+    while True:
+        result = predicate()
+        if result or time.time() >= deadline:
+            return result
+        time.sleep(interval)
+
+
 class Bootloader:
     """Bootloader utility for the Crazyflie"""
 
@@ -85,6 +108,7 @@ class Bootloader:
         self.terminate_flashing_cb = None  # type: Optional[Callable[[], bool]]
 
         self._boot_plat = None
+        self._platform_id = 'cf1'
 
         self._cload = Cloader(clink,
                               info_cb=None,
@@ -116,6 +140,7 @@ class Bootloader:
                 started = True
         if started:
             self.protocol_version = self._cload.protocol_version
+            self._platform_id = 'cf2' if BootVersion.is_cf2(self.protocol_version) else 'cf1'
 
             if (self.protocol_version == BootVersion.CF1_PROTO_VER_0 or
                     self.protocol_version == BootVersion.CF1_PROTO_VER_1):
@@ -135,21 +160,29 @@ class Bootloader:
     def flash(self, filename: str, targets: List[Target], cf=None):
         # Separate flash targets from decks
         platform = self._get_platform_id()
-        flash_targets = [t for t in targets if t.platform == platform]
-        deck_targets = [t for t in targets if t.platform == 'deck']
+        targets_by_platform = {}
+        for t in targets:
+            targets_by_platform.setdefault(t.platform, []).append(t)
+        flash_targets = targets_by_platform.get(platform, [])
+        deck_targets = targets_by_platform.get('deck', [])
 
         # Fetch artifacts from source file
-        artifacts = self._get_flash_artifacts_from_zip(filename)
-        if len(artifacts) == 0:
-            if len(targets) == 1:
-                content = open(filename, 'br').read()
-                artifacts = [FlashArtifact(content, targets[0])]
+        with open(filename, 'br') as f:
+            if zipfile.is_zipfile(f):
+                artifacts = self._get_flash_artifacts_from_zip(f)
+            elif len(targets) == 1:
+                # is_zipfile() leaves the file position at the end
+                f.seek(0)
+                artifacts = [FlashArtifact(f.read(), targets[0])]
             else:
                 raise(Exception('Cannot flash a .bin to more than one target!'))
 
         # Separate artifacts for flash and decks
-        flash_artifacts = [a for a in artifacts if a.target.platform == platform]
-        deck_artifacts = [a for a in artifacts if a.target.platform == 'deck']
+        artifacts_by_platform = {}
+        for a in artifacts:
+            artifacts_by_platform.setdefault(a.target.platform, []).append(a)
+        flash_artifacts = artifacts_by_platform.get(platform, [])
+        deck_artifacts = artifacts_by_platform.get('deck', [])
 
         # Flash the MCU flash
         if len(targets) == 0 or len(flash_targets) > 0:
@@ -166,7 +199,6 @@ class Bootloader:
                 # Reset to firmware mode
                 self.reset_to_firmware()
                 self.close()
-                time.sleep(3)
 
                 self._flash_deck(deck_artifacts, deck_targets)
 
@@ -217,23 +249,77 @@ class Bootloader:
             self.flash(filename, targets, cf)
             self.reset_to_firmware()
 
-    def _get_flash_artifacts_from_zip(self, filename):
-        if not zipfile.is_zipfile(filename):
-            return []
-
-        zf = zipfile.ZipFile(filename)
+    @classmethod
+    def flash_parallel(cls, uris: List[str], filename: str,
+                       targets: Optional[List[Target]] = None,
+                       max_workers: Optional[int] = None,
+                       progress_cb: Optional[Callable[[str, int], NoReturn]] = None):
+        """
+        Flash .zip or bin .file to several Crazyflies at the same time, using
+        one Bootloader per URI. The Crazyflies are warm booted and reset to
+        firmware when done. Messages passed to progress_cb are prefixed with
+        the URI of the Crazyflie they come from. progress_cb is called from
+        several worker threads at the same time and must be thread-safe.
+
+        Note that the bootloader link is always reopened on radio://0/..., so
+        all Crazyflies time-share dongle 0 whatever dongle the URIs name. The
+        speed-up comes only from overlapping the flash erase and write waits.
+
+        Every URI is attempted. If any of them fail a ParallelFlashError
+        mapping each failed URI to its exception is raised. A ValueError is
+        raised if the same URI is given more than once.
+        """
+        if not uris:
+            return
 
-        manifest = zf.read('manifest.json').decode('utf8')
-        manifest = json.loads(manifest)
+        if len(set(uris)) != len(uris):
+            raise ValueError('Each URI may only be flashed once')
 
-        if manifest['version'] != 1:
-            raise Exception('Wrong manifest version')
+        if targets is None:
+            targets = []
 
-        flash_artifacts = []
-        for (file, metadata) in manifest['files'].items():
-            content = zf.read(file)
-            target = Target(metadata['platform'], metadata['target'], metadata['type'])
-            flash_artifacts.append(FlashArtifact(content, target))
+        def flash_one(uri):
+            if progress_cb is not None:
+                def uri_progress_cb(msg, percent):
+                    progress_cb(f'{uri}: {msg}', percent)
+            else:
+                uri_progress_cb = None
+
+            bl = cls(uri)
+            try:
+                bl.flash_full(filename=filename, warm=True, targets=targets,
+                              progress_cb=uri_progress_cb)
+            finally:
+                bl.close()
+
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers or len(uris)) as executor:
+            futures = {executor.submit(flash_one, uri): uri for uri in uris}
+            for future in as_completed(futures):
+                uri = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.exception('Failed to flash %s', uri)
+                    errors[uri] = e
+
+        if errors:
+            # Report the failures in the order the URIs were given
+            errors = {uri: errors[uri] for uri in uris if uri in errors}
+            raise ParallelFlashError(errors) from next(iter(errors.values()))
+
+    def _get_flash_artifacts_from_zip(self, fh):
+        with zipfile.ZipFile(fh) as zf:
+            manifest = json.loads(zf.read('manifest.json'))
+
+            if manifest['version'] != 1:
+                raise Exception('Wrong manifest version')
+
+            flash_artifacts = []
+            for (file, metadata) in manifest['files'].items():
+                content = zf.read(file)
+                target = Target(metadata['platform'], metadata['target'], metadata['type'])
+                flash_artifacts.append(FlashArtifact(content, target))
 
         return flash_artifacts
 
@@ -258,134 +344,143 @@ class Bootloader:
         image = artifact.content
         t_data = target_info
 
+        # Bind what the page loop needs to locals
+        upload_buffer = self._cload.upload_buffer
+        progress_cb = self.progress_cb
+        terminate_flashing_cb = self.terminate_flashing_cb
+        addr = t_data.addr
+        page_size = t_data.page_size
+        buffer_pages = t_data.buffer_pages
+
+        # Slicing a memoryview does not copy the page data
+        image_view = memoryview(image)
+        image_len = len(image)
+        n_pages = (image_len + page_size - 1) // page_size
+
         start_page = target_info.start_page
 
         # If used from a UI we need some extra things for reporting progress
-        factor = (100.0 * t_data.page_size) / len(image)
         progress = 0
 
-        if self.progress_cb:
-            self.progress_cb(
+        target_name = TargetTypes.to_string(t_data.id)
+        upload_msg = f'Firmware ({current_file_number}/{total_files}) Uploading buffer to {target_name}...'
+        write_msg = f'Firmware ({current_file_number}/{total_files}) Writing buffer to {target_name}...'
+
+        if progress_cb:
+            progress_cb(
                 'Firmware ({}/{}) Starting...'.format(current_file_number, total_files),
-                int(progress))
+                progress)
         else:
             sys.stdout.write(
                 'Flashing {} of {} to {} ({}): '.format(
                     current_file_number, total_files,
-                    TargetTypes.to_string(t_data.id), artifact.target.type))
+                    target_name, artifact.target.type))
             sys.stdout.flush()
 
-        if len(image) > ((t_data.flash_pages - start_page) *
-                         t_data.page_size):
-            if self.progress_cb:
-                self.progress_cb('Error: Not enough space to flash the image file.', int(progress))
+        if image_len > ((t_data.flash_pages - start_page) *
+                        page_size):
+            if progress_cb:
+                progress_cb('Error: Not enough space to flash the image file.', progress)
             else:
                 print('Error: Not enough space to flash the image file.')
             raise Exception('Not enough space to flash the image file')
 
-        if not self.progress_cb:
-            logger.info(('%d bytes (%d pages) ' % (
-                (len(image) - 1), int(len(image) / t_data.page_size) + 1)))
-            sys.stdout.write(('%d bytes (%d pages) ' % (
-                (len(image) - 1), int(len(image) / t_data.page_size) + 1)))
+        if image_len == 0:
+            if progress_cb:
+                progress_cb('Error: Image file is empty.', progress)
+            else:
+                print('Error: Image file is empty.')
+            raise Exception('Image file is empty')
+
+        if not progress_cb:
+            logger.info('%d bytes (%d pages) ' % (image_len, n_pages))
+            sys.stdout.write('%d bytes (%d pages) ' % (image_len, n_pages))
             sys.stdout.flush()
 
         # For each page
         ctr = 0  # Buffer counter
-        for i in range(0, int((len(image) - 1) / t_data.page_size) + 1):
-            if self.terminate_flashing_cb and self.terminate_flashing_cb():
+        offset = 0
+        for i in range(0, n_pages):
+            if terminate_flashing_cb and terminate_flashing_cb():
                 raise Exception('Flashing terminated')
 
-            # Load the buffer
-            if ((i + 1) * t_data.page_size) > len(image):
-                self._cload.upload_buffer(
-                    t_data.addr, ctr, 0, image[i * t_data.page_size:])
-            else:
-                self._cload.upload_buffer(
-                    t_data.addr, ctr, 0,
-                    image[i * t_data.page_size: (i + 1) * t_data.page_size])
+            # Load the buffer, the last page may be shorter than page_size
+            upload_buffer(addr, ctr, 0, image_view[offset:offset + page_size])
+            offset += page_size
 
             ctr += 1
 
-            if self.progress_cb:
-                progress += factor
-                self.progress_cb('Firmware ({}/{}) Uploading buffer to {}...'.format(
-                    current_file_number,
-                    total_files,
-                    TargetTypes.to_string(t_data.id)),
-
-                    int(progress))
+            if progress_cb:
+                # Only report when the percentage moves
+                page_progress = ((i + 1) * 100) // n_pages
+                if page_progress != progress:
+                    progress = page_progress
+                    progress_cb(upload_msg, progress)
             else:
                 sys.stdout.write('.')
                 sys.stdout.flush()
 
             # Flash when the complete buffers are full
-            if ctr >= t_data.buffer_pages:
-                if self.progress_cb:
-                    self.progress_cb('Firmware ({}/{}) Writing buffer to {}...'.format(
-                        current_file_number,
-                        total_files,
-                        TargetTypes.to_string(t_data.id)),
-
-                        int(progress))
-                else:
-                    sys.stdout.write('%d' % ctr)
-                    sys.stdout.flush()
-                if not self._cload.write_flash(t_data.addr, 0,
-                                               start_page + i - (ctr - 1),
-                                               ctr):
-                    if self.progress_cb:
-                        self.progress_cb(
-                            'Error during flash operation (code {})'.format(
-                                self._cload.error_code),
-                            int(progress))
-                    else:
-                        print('\nError during flash operation (code %d). '
-                              'Maybe wrong radio link?' %
-                              self._cload.error_code)
-                    raise Exception()
-
+            if ctr >= buffer_pages:
+                self._write_current_buffer(addr, start_page + i - (ctr - 1), ctr, progress, write_msg)
                 ctr = 0
 
         if ctr > 0:
+            self._write_current_buffer(addr, start_page + (n_pages - 1) - (ctr - 1), ctr, progress, write_msg)
+
+    def _write_current_buffer(self, addr, flash_page, ctr, progress, write_msg):
+        """Write the ctr pages loaded in the buffer to flash, starting at
+        flash_page"""
+        if self.progress_cb:
+            self.progress_cb(write_msg, progress)
+        else:
+            sys.stdout.write('%d' % ctr)
+            sys.stdout.flush()
+
+        if not self._cload.write_flash(addr, 0, flash_page, ctr):
             if self.progress_cb:
-                self.progress_cb('Firmware ({}/{}) Writing buffer to {}...'.format(
-                    current_file_number,
-                    total_files,
-                    TargetTypes.to_string(t_data.id)),
-                    int(progress))
+                self.progress_cb(
+                    'Error during flash operation (code {})'.format(
+                        self._cload.error_code),
+                    progress)
             else:
-                sys.stdout.write('%d' % ctr)
-                sys.stdout.flush()
-            if not self._cload.write_flash(
-                    t_data.addr, 0,
-                    (start_page + (int((len(image) - 1) / t_data.page_size)) -
-                     (ctr - 1)), ctr):
-                if self.progress_cb:
-                    self.progress_cb(
-                        'Error during flash operation (code {})'.format(
-                            self._cload.error_code),
-                        int(progress))
-                else:
-                    print('\nError during flash operation (code %d). Maybe'
-                          ' wrong radio link?' % self._cload.error_code)
-                raise Exception()
+                print('\nError during flash operation (code %d). '
+                      'Maybe wrong radio link?' %
+                      self._cload.error_code)
+            raise Exception()
 
     def _get_platform_id(self):
         """Get platform identifier used in the zip manifest for curr copter"""
-        identifier = 'cf1'
-        if (BootVersion.is_cf2(self.protocol_version)):
-            identifier = 'cf2'
-
-        return identifier
+        return self._platform_id
 
     def _flash_deck(self, artifacts: List[FlashArtifact], targets: List[Target]):
         flash_all_targets = len(targets) == 0
-
-        if self.progress_cb:
-            self.progress_cb('Detecting deck to be updated', int(25))
-
-        with SyncCrazyflie(self.clink, cf=Crazyflie()) as scf:
+        progress_cb = self.progress_cb
+        terminate_flashing_cb = self.terminate_flashing_cb
+
+        if progress_cb:
+            progress_cb('Detecting deck to be updated', int(25))
+
+        scf = SyncCrazyflie(self.clink, cf=Crazyflie())
+        last_error = None
+
+        def try_open_link():
+            nonlocal last_error
+            try:
+                scf.open_link()
+            except Exception as e:
+                last_error = e
+                return False
+            return True
+
+        # Wait for the firmware to come up after the reset, retrying on the
+        # same Crazyflie instance. The 10 s are only checked between attempts,
+        # each open_link() blocks until the connection succeeds or fails.
+        if not _wait_for(try_open_link, timeout=10.0, interval=0.5):
+            raise Exception(
+                f'Could not connect to the firmware to update decks: {last_error}') from last_error
+
+        try:
             deck_mems = scf.cf.mem.get_mems(MemoryElement.TYPE_DECK_MEMORY)
             deck_mems_count = len(deck_mems)
             if deck_mems_count == 0:
@@ -395,7 +490,7 @@ class Bootloader:
             decks = mgr.query_decks()
 
             for (deck_index, deck) in decks.items():
-                if self.terminate_flashing_cb and self.terminate_flashing_cb():
+                if terminate_flashing_cb and terminate_flashing_cb():
                     raise Exception('Flashing terminated')
 
                 # Check that we want to flash this deck
@@ -411,14 +506,17 @@ class Bootloader:
                     continue
                 deck_artifact = deck_artifacts[0]
 
-                if self.progress_cb:
-                    self.progress_cb(f'Updating deck {deck.name}', int(50))
+                if progress_cb:
+                    progress_cb(f'Updating deck {deck.name}', int(50))
                 print(f'Handling {deck.name}')
 
                 # Test and wait for the deck to be started
-                while not deck.is_started:
+                if not deck.is_started:
                     print('Deck not yet started ...')
-                    time.sleep(500)
+                    if not _wait_for(lambda: mgr.query_decks()[deck_index].is_started, timeout=5.0, interval=0.1):
+                        if progress_cb:
+                            progress_cb(f'Deck {deck.name} did not start', int(0))
+                        raise Exception(f'Deck {deck.name} did not start')
                     deck = mgr.query_decks()[deck_index]
 
                 # Run a brunch of sanity checks ...
@@ -437,9 +535,11 @@ class Bootloader:
                 # ToDo, white the correct file there ...
                 result = deck.write_sync(0, deck_artifact.content)
                 if result:
-                    if self.progress_cb:
-                        self.progress_cb(f'Deck {deck.name} updated succesfully!', int(75))
+                    if progress_cb:
+                        progress_cb(f'Deck {deck.name} updated succesfully!', int(75))
                 else:
-                    if self.progress_cb:
-                        self.progress_cb(f'Failed to update deck {deck.name}', int(0))
+                    if progress_cb:
+                        progress_cb(f'Failed to update deck {deck.name}', int(0))
                     raise Exception(f'Failed to update deck {deck.name}')
+        finally:
+            scf.close_link()
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2021 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+import json
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest.mock import call
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from cflib.bootloader import _wait_for
+from cflib.bootloader import Bootloader
+from cflib.bootloader import FlashArtifact
+from cflib.bootloader import ParallelFlashError
+from cflib.bootloader import Target
+from cflib.bootloader.boottypes import TargetTypes
+
+
+class FakeClock:
+    """Replaces the time module used by cflib.bootloader, sleep() advances
+    the clock instead of blocking"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@patch('cflib.bootloader.time', new_callable=FakeClock)
+class WaitForTest(unittest.TestCase):
+
+    def test_that_truthy_value_is_returned_at_once(self, clock):
+        # Fixture
+        predicate = MagicMock(return_value='ready')
+
+        # Test
+        actual = _wait_for(predicate, timeout=1.0, interval=0.1)
+
+        # Assert
+        self.assertEqual('ready', actual)
+        self.assertEqual(1, predicate.call_count)
+        self.assertEqual(0.0, clock.now)
+
+    def test_that_predicate_is_polled_until_truthy(self, clock):
+        # Fixture
+        predicate = MagicMock(side_effect=[False, None, True])
+
+        # Test
+        actual = _wait_for(predicate, timeout=1.0, interval=0.1)
+
+        # Assert
+        self.assertTrue(actual)
+        self.assertEqual(3, predicate.call_count)
+        self.assertAlmostEqual(0.2, clock.now)
+
+    def test_that_last_value_is_returned_on_timeout(self, clock):
+        # Fixture
+        predicate = MagicMock(return_value=0)
+
+        # Test
+        actual = _wait_for(predicate, timeout=1.0, interval=0.25)
+
+        # Assert
+        self.assertEqual(0, actual)
+        self.assertEqual(5, predicate.call_count)
+
+
+@patch.object(Bootloader, 'close')
+@patch.object(Bootloader, 'flash_full', autospec=True)
+class BootloaderFlashParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.uris = [
+            'radio://0/80/2M/E7E7E7E701',
+            'radio://0/80/2M/E7E7E7E702',
+            'radio://0/80/2M/E7E7E7E703',
+        ]
+
+    def test_that_all_uris_are_flashed(self, flash_full_mock, close_mock):
+        # Fixture
+
+        # Test
+        Bootloader.flash_parallel(self.uris, 'fw.zip')
+
+        # Assert
+        flashed = sorted(c.args[0].clink for c in flash_full_mock.call_args_list)
+        self.assertEqual(self.uris, flashed)
+        self.assertEqual(len(self.uris), close_mock.call_count)
+        for c in flash_full_mock.call_args_list:
+            self.assertEqual('fw.zip', c.kwargs['filename'])
+            self.assertTrue(c.kwargs['warm'])
+            self.assertEqual([], c.kwargs['targets'])
+
+    def test_that_progress_messages_are_prefixed_with_uri(self, flash_full_mock, close_mock):
+        # Fixture
+        def flash_full(bl, **kwargs):
+            kwargs['progress_cb']('Flashing', 42)
+
+        flash_full_mock.side_effect = flash_full
+        progress_cb = MagicMock()
+
+        # Test
+        Bootloader.flash_parallel(self.uris, 'fw.zip', progress_cb=progress_cb)
+
+        # Assert
+        expected = [call(f'{uri}: Flashing', 42) for uri in self.uris]
+        progress_cb.assert_has_calls(expected, any_order=True)
+        self.assertEqual(len(self.uris), progress_cb.call_count)
+
+    def test_that_remaining_uris_are_flashed_after_failure(self, flash_full_mock, close_mock):
+        # Fixture
+        error = Exception('Could not connect to bootloader')
+
+        def flash_full(bl, **kwargs):
+            if bl.clink == self.uris[0]:
+                raise error
+
+        flash_full_mock.side_effect = flash_full
+
+        # Test
+        with self.assertLogs('cflib.bootloader', level='ERROR'):
+            with self.assertRaises(ParallelFlashError) as context:
+                Bootloader.flash_parallel(self.uris, 'fw.zip', max_workers=1)
+
+        # Assert
+        self.assertEqual(len(self.uris), flash_full_mock.call_count)
+        self.assertEqual(len(self.uris), close_mock.call_count)
+        self.assertEqual({self.uris[0]: error}, context.exception.errors)
+        self.assertIs(error, context.exception.__cause__)
+
+    def test_that_error_lists_all_failed_uris(self, flash_full_mock, close_mock):
+        # Fixture
+        def flash_full(bl, **kwargs):
+            if bl.clink != self.uris[1]:
+                raise Exception('Flash write error')
+
+        flash_full_mock.side_effect = flash_full
+
+        # Test
+        with self.assertLogs('cflib.bootloader', level='ERROR'):
+            with self.assertRaises(ParallelFlashError) as context:
+                Bootloader.flash_parallel(self.uris, 'fw.zip')
+
+        # Assert
+        failed = [self.uris[0], self.uris[2]]
+        self.assertEqual(failed, list(context.exception.errors))
+        for uri in failed:
+            self.assertIn(uri, str(context.exception))
+        self.assertNotIn(self.uris[1], str(context.exception))
+
+    def test_that_empty_uris_does_nothing(self, flash_full_mock, close_mock):
+        # Fixture
+
+        # Test
+        Bootloader.flash_parallel([], 'fw.zip')
+
+        # Assert
+        flash_full_mock.assert_not_called()
+        close_mock.assert_not_called()
+
+    def test_that_duplicate_uris_are_rejected(self, flash_full_mock, close_mock):
+        # Fixture
+        uris = [self.uris[0], self.uris[1], self.uris[0]]
+
+        # Test
+        with self.assertRaises(ValueError):
+            Bootloader.flash_parallel(uris, 'fw.zip')
+
+        # Assert
+        flash_full_mock.assert_not_called()
+        close_mock.assert_not_called()
+
+
+@patch('cflib.bootloader.time', new_callable=FakeClock)
+@patch('cflib.bootloader.Crazyflie')
+@patch('cflib.bootloader.SyncCrazyflie')
+class BootloaderFlashDeckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sut = Bootloader('radio://0/80/2M/E7E7E7E7E7')
+        self.progress_cb = MagicMock()
+        self.sut.progress_cb = self.progress_cb
+
+    def test_that_link_is_retried_on_the_same_crazyflie(self, scf_class_mock, cf_class_mock, clock):
+        # Fixture
+        scf = scf_class_mock.return_value
+        scf.open_link.side_effect = [Exception('Too many packets lost'), Exception('Too many packets lost'), None]
+        scf.cf.mem.get_mems.return_value = []
+
+        # Test
+        self.sut._flash_deck([], [])
+
+        # Assert
+        scf_class_mock.assert_called_once_with(self.sut.clink, cf=cf_class_mock.return_value)
+        self.assertEqual(3, scf.open_link.call_count)
+        scf.close_link.assert_called_once_with()
+
+    def test_that_last_link_error_is_chained_when_connection_fails(self, scf_class_mock, cf_class_mock, clock):
+        # Fixture
+        error = Exception('Too many packets lost')
+        scf = scf_class_mock.return_value
+        scf.open_link.side_effect = error
+
+        # Test
+        with self.assertRaises(Exception) as context:
+            self.sut._flash_deck([], [])
+
+        # Assert
+        self.assertIs(error, context.exception.__cause__)
+        self.assertIn('Too many packets lost', str(context.exception))
+        scf_class_mock.assert_called_once()
+
+    @patch('cflib.bootloader.deck_memory.SyncDeckMemoryManager')
+    def test_that_deck_not_started_fails_the_update(self, mgr_class_mock, scf_class_mock, cf_class_mock, clock):
+        # Fixture
+        scf = scf_class_mock.return_value
+        scf.cf.mem.get_mems.return_value = [MagicMock()]
+        deck = MagicMock()
+        deck.name = 'bcTest'
+        deck.is_started = False
+        mgr_class_mock.return_value.query_decks.return_value = {0: deck}
+        artifacts = [FlashArtifact(b'fw', Target('deck', 'bcTest', 'fw'))]
+
+        # Test
+        with self.assertRaises(Exception):
+            self.sut._flash_deck(artifacts, [])
+
+        # Assert
+        deck.write_sync.assert_not_called()
+        self.progress_cb.assert_called_with('Deck bcTest did not start', 0)
+        scf.close_link.assert_called_once_with()
+
+
+class BootloaderInternalFlashTest(unittest.TestCase):
+
+    PAGE_SIZE = 1024
+    START_PAGE = 10
+
+    def setUp(self):
+        self.sut = Bootloader('radio://0/80/2M/E7E7E7E7E7')
+        self.cload_mock = MagicMock()
+        self.cload_mock.write_flash.return_value = True
+        self.sut._cload = self.cload_mock
+        self.progress_cb = MagicMock()
+        self.sut.progress_cb = self.progress_cb
+
+        self._set_target(buffer_pages=10)
+
+    def test_that_empty_image_fails(self):
+        # Fixture
+
+        # Test
+        with self.assertRaises(Exception):
+            self.sut._internal_flash(FlashArtifact(b'', Target('cf2', 'stm32', 'fw')))
+
+        # Assert
+        self.cload_mock.upload_buffer.assert_not_called()
+        self.cload_mock.write_flash.assert_not_called()
+        self.progress_cb.assert_called_with('Error: Image file is empty.', 0)
+
+    def test_that_pages_are_uploaded_and_written(self):
+        cases = [
+            ('multiple of page size', 4 * self.PAGE_SIZE, 3),
+            ('partial last page', 4 * self.PAGE_SIZE + 904, 3),
+            ('one short page', 100, 3),
+            ('all pages in one buffer', 2 * self.PAGE_SIZE + 1, 10),
+        ]
+        for (name, size, buffer_pages) in cases:
+            with self.subTest(name):
+                # Fixture
+                self.cload_mock.reset_mock()
+                self._set_target(buffer_pages)
+                image = bytes((i * 7) & 0xFF for i in range(size))
+
+                # Test
+                self.sut._internal_flash(FlashArtifact(image, Target('cf2', 'stm32', 'fw')))
+
+                # Assert
+                n_pages = -(-size // self.PAGE_SIZE)
+                expected_uploads = [
+                    (TargetTypes.STM32, i % buffer_pages, 0, image[i * self.PAGE_SIZE:(i + 1) * self.PAGE_SIZE])
+                    for i in range(n_pages)]
+                actual_uploads = [
+                    (c.args[0], c.args[1], c.args[2], bytes(c.args[3]))
+                    for c in self.cload_mock.upload_buffer.call_args_list]
+                self.assertEqual(expected_uploads, actual_uploads)
+
+                expected_writes = [
+                    call(TargetTypes.STM32, 0, self.START_PAGE + first, min(buffer_pages, n_pages - first))
+                    for first in range(0, n_pages, buffer_pages)]
+                self.assertEqual(expected_writes, self.cload_mock.write_flash.call_args_list)
+
+    def test_that_upload_progress_rises_to_exactly_100(self):
+        for size in (4 * self.PAGE_SIZE, 4 * self.PAGE_SIZE + 904, 100, 300 * self.PAGE_SIZE):
+            with self.subTest(size=size):
+                # Fixture
+                self.progress_cb.reset_mock()
+                image = bytes(size)
+
+                # Test
+                self.sut._internal_flash(FlashArtifact(image, Target('cf2', 'stm32', 'fw')))
+
+                # Assert
+                upload_progress = [
+                    c.args[1] for c in self.progress_cb.call_args_list
+                    if c.args[0].startswith('Firmware (1/1) Uploading buffer')]
+                self.assertTrue(len(upload_progress) > 0)
+                for (previous, current) in zip(upload_progress, upload_progress[1:]):
+                    self.assertLess(previous, current)
+                self.assertEqual(100, upload_progress[-1])
+                self.assertLessEqual(max(c.args[1] for c in self.progress_cb.call_args_list), 100)
+
+    def _set_target(self, buffer_pages):
+        target = MagicMock()
+        target.id = TargetTypes.STM32
+        target.addr = TargetTypes.STM32
+        target.page_size = self.PAGE_SIZE
+        target.buffer_pages = buffer_pages
+        target.flash_pages = 1024
+        target.start_page = self.START_PAGE
+        self.cload_mock.targets = {TargetTypes.STM32: target}
+
+
+class BootloaderFlashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sut = Bootloader('radio://0/80/2M/E7E7E7E7E7')
+        self.sut._platform_id = 'cf2'
+        self.sut.progress_cb = MagicMock()
+        self.sut._flash_flash = MagicMock()
+
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_that_bin_file_is_flashed_with_its_full_content(self):
+        # Fixture
+        content = bytes((i * 7) & 0xFF for i in range(5000))
+        with open(self.filename, 'wb') as f:
+            f.write(content)
+        target = Target('cf2', 'stm32', 'fw')
+
+        # Test
+        self.sut.flash(self.filename, [target])
+
+        # Assert
+        self.sut._flash_flash.assert_called_once_with([FlashArtifact(content, target)], [target])
+
+    def test_that_zip_artifacts_come_from_the_manifest(self):
+        # Fixture
+        manifest = {
+            'version': 1,
+            'files': {
+                'cf2_stm32.bin': {'platform': 'cf2', 'target': 'stm32', 'type': 'fw'},
+                'cf2_nrf51.bin': {'platform': 'cf2', 'target': 'nrf51', 'type': 'fw'},
+                'bcTest.bin': {'platform': 'deck', 'target': 'bcTest', 'type': 'fw'},
+            }
+        }
+        with zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('manifest.json', json.dumps(manifest))
+            zf.writestr('cf2_stm32.bin', b'stm32' * 100)
+            zf.writestr('cf2_nrf51.bin', b'nrf51' * 100)
+            zf.writestr('bcTest.bin', b'deck' * 100)
+        targets = [Target('cf2', 'stm32', 'fw'), Target('cf2', 'nrf51', 'fw')]
+
+        # Test
+        self.sut.flash(self.filename, targets)
+
+        # Assert
+        expected = [
+            FlashArtifact(b'stm32' * 100, Target('cf2', 'stm32', 'fw')),
+            FlashArtifact(b'nrf51' * 100, Target('cf2', 'nrf51', 'fw')),
+        ]
+        self.sut._flash_flash.assert_called_once_with(expected, targets)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+#     ||          ____  _ __
+#  +------+      / __ )(_) /_______________ _____  ___
+#  | 0xBC |     / __  / / __/ ___/ ___/ __ `/_  / / _ \
+#  +------+    / /_/ / / /_/ /__/ /  / /_/ / / /_/  __/
+#   ||  ||    /_____/_/\__/\___/_/   \__,_/ /___/\___/
+#
+#  Copyright (C) 2021 Bitcraze AB
+#
+#  Crazyflie Nano Quadcopter Client
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA  02110-1301, USA.
+import struct
+import unittest
+from unittest.mock import MagicMock
+
+from cflib.bootloader.cloader import Cloader
+
+
+class CloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.sut = Cloader('radio://0/80/2M/E7E7E7E7E7')
+        self.sut.link = MagicMock()
+        self.sut.link.send_packet.side_effect = self._send_packet
+
+    def test_upload_buffer_splits_data_into_packets(self):
+        for length in (0, 1, 24, 25, 26, 1024):
+            for wrap in (bytes, memoryview):
+                with self.subTest(length=length, type=wrap.__name__):
+                    # Fixture
+                    self.sent.clear()
+                    data = bytes((i * 7) & 0xFF for i in range(length))
+                    page = 3
+                    address = 10
+
+                    # Test
+                    self.sut.upload_buffer(0xFF, page, address, wrap(data))
+
+                    # Assert
+                    expected = []
+                    for offset in range(0, length, 25):
+                        expected.append(
+                            (0xFF, 0xFF, struct.pack('=BBHH', 0xFF, 0x14, page, address + offset) +
+                             data[offset:offset + 25]))
+                    self.assertEqual(expected, self.sent)
+
+    def test_upload_buffer_sends_no_empty_trailing_packet(self):
+        # Fixture
+        data = bytes(50)
+
+        # Test
+        self.sut.upload_buffer(0xFF, 0, 0, memoryview(data))
+
+        # Assert
+        self.assertEqual(2, len(self.sent))
+        self.assertEqual([25, 25], [len(payload) - 6 for (_, _, payload) in self.sent])
+
+    def _send_packet(self, pk):
+        self.sent.append((pk.port, pk.channel, bytes(pk.data)))